@@ -1,7 +1,14 @@
+import asyncio
 import logging
-from pathlib import Path
+import logging.handlers
+import os
+import queue
+import time
+from contextlib import suppress
 
+from sqlalchemy import String, cast, func, select
 from telegram import ChatMemberUpdated, Update
+from telegram.constants import MessageLimit
 from telegram.ext import (
     Application,
     CallbackContext,
@@ -12,119 +19,157 @@ from telegram.ext import (
 )
 
 from database import (
+    Hashtag,
     Message,
     MessageVersion,
-    save_message,
+    User,
+    dispose_engine,
+    init_db,
+    message_queue,
+    normalize_hashtag,
+    queue_edit,
+    queue_message,
+    read_setting,
+    run_message_writer,
     session_scope,
-    update_message,
 )
 
-path = Path(__file__).parent.joinpath("token.txt")
-print(path)
-with path.open() as f:
-    TELEGRAM_BOT_TOKEN = f.read().strip()
+TELEGRAM_BOT_TOKEN = read_setting("TELEGRAM_BOT_TOKEN", "token.txt")
 
 
-# Логирование
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
+# Логирование: обработчики только кладут записи в очередь, а форматирование
+# и вывод выполняются в отдельном потоке и не блокируют цикл событий
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 )
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
 logger = logging.getLogger(__name__)
 
+# Статусы, при которых пользователь считается участником чата
+MEMBER_STATUSES = frozenset(
+    ("member", "restricted", "creator", "administrator")
+)
+ADMIN_STATUSES = frozenset(("creator", "administrator"))
+
+# Сколько результатов поиска загружать из базы за один запрос
+SEARCH_PAGE_SIZE = 20
+# Ограничения на один ответ поиска: больше личных сообщений подряд Telegram
+# не даст отправить без RetryAfter
+SEARCH_MAX_RESULTS = 100
+SEARCH_MAX_REPLIES = 10
+
+# Кэш администраторов чатов: список меняется редко, а каждый запрос к
+# Telegram API расходует лимит бота
+ADMINS_CACHE_TTL = 300
+ADMIN_STATUS_CACHE_TTL = 60
+_admin_cache: dict[int, tuple[float, list]] = {}
+_admin_status_cache: dict[tuple[int, int], tuple[float, str]] = {}
+
 
 async def handle_new_message(update: Update, context: CallbackContext) -> None:
-    if update.effective_user.is_bot:
-        logger.info(
-            f"Ignoring message from bot: {update.effective_user.username}"
-        )
+    user = update.effective_user
+    message = update.message
+
+    if user.is_bot:
+        logger.info("Ignoring message from bot: %s", user.username)
         return
 
-    if update.message is None or update.message.text is None:
+    if message is None or message.text is None:
         logger.info("Message does not contain text, skipping...")
         return
 
     chat_id = update.effective_chat.id
-    user = update.effective_user
-    text = update.message.text
-    message_id = update.message.message_id
+    text = message.text
 
-    try:
-        with session_scope() as session:
-            save_message(session, chat_id, user, text, message_id)
-            logger.info(f"Saved message from {user.username}: {text}")
-    except Exception as e:
-        logger.error(f"Error saving message from {user.username}: {e}")
+    queue_message(chat_id, user, text, message.message_id, message.date)
+    logger.info("Queued message from %s: %s", user.username, text)
 
 
 async def handle_edited_message(
     update: Update, context: CallbackContext
 ) -> None:
-    if update.effective_user.is_bot:
+    effective_user = update.effective_user
+    edited_message = update.edited_message
+
+    if effective_user.is_bot:
         logger.info(
-            f"Ignoring edited message from bot: {update.effective_user.username}"
+            "Ignoring edited message from bot: %s", effective_user.username
         )
         return
 
-    if update.edited_message is None:
+    if edited_message is None:
         logger.info("Edited message is None, skipping...")
         return
 
-    chat_id = update.edited_message.chat_id
-    user = update.edited_message.from_user
+    chat_id = edited_message.chat_id
+    user = edited_message.from_user
     if user is None:
         logger.info("User information is None, skipping...")
         return
-    message_id = update.edited_message.message_id
-    new_text = update.edited_message.text
-    edited_at = update.edited_message.edit_date
+    message_id = edited_message.message_id
+    new_text = edited_message.text
+    edited_at = edited_message.edit_date
 
     logger.info(
-        f"Handling edited message: chat_id={chat_id}, user_id={user.id}, new_text={new_text}"
+        "Handling edited message: chat_id=%s, user_id=%s, new_text=%s",
+        chat_id,
+        user.id,
+        new_text,
     )
 
-    try:
-        with session_scope() as session:
-            update_message(
-                session, chat_id, user.id, message_id, new_text, edited_at
-            )
-            logger.info(f"Message edited by {user.username}: {new_text}")
-    except Exception as e:
-        logger.error(f"Error handling edited message: {e}")
+    # Правка пишется через ту же очередь, что и новые сообщения, иначе она
+    # может опередить ещё не записанное сообщение и потеряться
+    queue_edit(chat_id, user.id, message_id, new_text, edited_at)
+    logger.info("Queued edit by %s: %s", user.username, new_text)
 
 
 async def track_chat_members(update: Update, context: CallbackContext) -> None:
-    if not update.chat_member:
+    chat_member = update.chat_member
+    if not chat_member:
         logger.warning("No chat_member information in the update.")
         return
 
-    result = extract_status_change(update.chat_member)
+    result = extract_status_change(chat_member)
     if result is None:
         return
 
     was_member, is_member = result
-    member = update.chat_member.new_chat_member.user
+    member = chat_member.new_chat_member.user
 
     if member.is_bot:
-        logger.info(f"Ignoring bot member change: {member.username}")
+        logger.info("Ignoring bot member change: %s", member.username)
         return
 
-    chat_title = update.chat_member.chat.title or "Private Chat"
+    chat_id = chat_member.chat.id
+    chat_title = chat_member.chat.title or "Private Chat"
 
     if not was_member and is_member:
         message = f"Пользователь {member.full_name} был добавлен в чат '{chat_title}'."
         logger.info(message)
         try:
-            await notify_admins(context, update.effective_chat.id, message)
+            await notify_admins(context, chat_id, message)
         except Exception as e:
-            logger.error(f"Error notifying admins about new member: {e}")
+            logger.error("Error notifying admins about new member: %s", e)
     elif was_member and not is_member:
         message = f"Пользователь {member.full_name} покинул чат '{chat_title}'."
         logger.info(message)
         try:
-            await notify_admins(context, update.effective_chat.id, message)
+            await notify_admins(context, chat_id, message)
         except Exception as e:
-            logger.error(f"Error notifying admins about member leaving: {e}")
+            logger.error("Error notifying admins about member leaving: %s", e)
+
+
+async def get_chat_admins(context: CallbackContext, chat_id: int) -> list:
+    now = time.monotonic()
+    entry = _admin_cache.get(chat_id)
+    if entry and now - entry[0] < ADMINS_CACHE_TTL:
+        return entry[1]
+
+    admins = await context.bot.get_chat_administrators(chat_id)
+    _admin_cache[chat_id] = (now, admins)
+    return admins
 
 
 async def notify_admins(
@@ -132,33 +177,42 @@ async def notify_admins(
 ) -> None:
     try:
         # Получаем список администраторов чата
-        admins = await context.bot.get_chat_administrators(chat_id)
+        admins = await get_chat_admins(context, chat_id)
 
         if not admins:
             logger.info("No administrators found in the chat.")
             return
 
+        # Исключаем ботов
+        recipients = [admin for admin in admins if not admin.user.is_bot]
+
+        # Отправляем уведомления всем администраторам одновременно
+        send_results = await asyncio.gather(
+            *[
+                context.bot.send_message(chat_id=admin.user.id, text=message)
+                for admin in recipients
+            ],
+            return_exceptions=True,
+        )
+
         notified_count = 0
+        for admin, result in zip(recipients, send_results):
+            if isinstance(result, Exception):
+                logger.warning(
+                    "Failed to notify admin %s: %s",
+                    admin.user.full_name,
+                    result,
+                )
+            else:
+                logger.info(
+                    "Notified admin %s: %s", admin.user.full_name, message
+                )
+                notified_count += 1
 
-        for admin in admins:
-            if not admin.user.is_bot:  # Исключаем ботов
-                try:
-                    await context.bot.send_message(
-                        chat_id=admin.user.id, text=message
-                    )
-                    logger.info(
-                        f"Notified admin {admin.user.full_name}: {message}"
-                    )
-                    notified_count += 1
-                except Exception as e:
-                    logger.warning(
-                        f"Failed to notify admin {admin.user.full_name}: {e}"
-                    )
-
-        logger.info(f"Total notified admins: {notified_count}")
+        logger.info("Total notified admins: %s", notified_count)
 
     except Exception as e:
-        logger.error(f"Failed to fetch administrators: {e}")
+        logger.error("Failed to fetch administrators: %s", e)
 
 
 def extract_status_change(
@@ -171,63 +225,87 @@ def extract_status_change(
     old_status, new_status = status_change
 
     # Определяем, был ли пользователь участником чата и является ли он участником сейчас
-    was_member = old_status in [
-        "member",
-        "restricted",
-        "creator",
-        "administrator",
-    ]
-    is_member = new_status in [
-        "member",
-        "restricted",
-        "creator",
-        "administrator",
-    ]
+    was_member = old_status in MEMBER_STATUSES
+    is_member = new_status in MEMBER_STATUSES
 
     # Логируем изменения статуса
     logger.info(
-        f"Status changed from {old_status} to {new_status}. Was member: {was_member}, Is member: {is_member}"
+        "Status changed from %s to %s. Was member: %s, Is member: %s",
+        old_status,
+        new_status,
+        was_member,
+        is_member,
     )
 
     return was_member, is_member
 
 
 async def search_hashtag(update: Update, context: CallbackContext) -> None:
+    message = update.message
+    user = update.effective_user
+
     # Проверяем, является ли пользователь администратором
     if not await is_user_admin(update, context):
-        await update.message.reply_text(
+        await message.reply_text(
             "Эта команда доступна только администраторам чата."
         )
         return
 
     # Получаем хештег из аргументов команды
     hashtag = context.args[0] if context.args else None
-    if not hashtag or not hashtag.startswith("#"):
-        await update.message.reply_text(
+    tag = normalize_hashtag(hashtag) if hashtag else None
+    if not tag:
+        await message.reply_text(
             "Укажите хештег для поиска (например, /search_hashtag #example)."
         )
         return
 
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
+    user_id = user.id
 
     try:
-        # Ищем сообщения по хештегу
-        results = await find_messages_by_hashtag(chat_id, hashtag)
-
-        if results:
-            # Формируем сообщение с результатами поиска
-            message_lines = [
+        # Ищем сообщения по хештегу и отправляем результаты постранично,
+        # не собирая их все в памяти
+        found = 0
+        sent = 0
+        truncated = False
+        async for page in find_messages_by_hashtag(chat_id, tag):
+            remaining = SEARCH_MAX_RESULTS - found
+            if len(page) > remaining:
+                page = page[:remaining]
+                truncated = True
+            blocks = [
                 f"Текст: {msg['text']}\nАвтор: {msg['author']}\n"
-                for msg in results
+                for msg in page
             ]
-            message = "Результаты поиска по хештегу:\n\n" + "\n\n".join(
-                message_lines
+            if not found:
+                blocks.insert(0, "Результаты поиска по хештегу:")
+            found += len(page)
+
+            for reply in pack_messages(blocks):
+                if sent == SEARCH_MAX_REPLIES:
+                    truncated = True
+                    break
+                await context.bot.send_message(chat_id=user_id, text=reply)
+                sent += 1
+            if truncated:
+                break
+
+        if truncated:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=(
+                    "Показаны не все найденные сообщения: результатов "
+                    "слишком много для одного ответа."
+                ),
             )
-
-            await context.bot.send_message(chat_id=user_id, text=message)
+        if found:
             logger.info(
-                f"Searched hashtag #{hashtag} by admin {update.effective_user.name}"
+                "Searched hashtag #%s by admin %s, found %s messages%s",
+                tag,
+                user.name,
+                found,
+                " (truncated)" if truncated else "",
             )
         else:
             await context.bot.send_message(
@@ -235,7 +313,7 @@ async def search_hashtag(update: Update, context: CallbackContext) -> None:
                 text="Сообщения с указанным хештегом не найдены.",
             )
     except Exception as e:
-        logger.error(f"Error while searching for hashtag #{hashtag}: {e}")
+        logger.error("Error while searching for hashtag #%s: %s", tag, e)
         await context.bot.send_message(
             chat_id=user_id, text="Произошла ошибка при поиске сообщений."
         )
@@ -245,77 +323,123 @@ async def is_user_admin(update: Update, context: CallbackContext) -> bool:
     try:
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
-        chat_member = await context.bot.get_chat_member(chat_id, user_id)
 
-        # Логируем информацию о статусе
-        logger.info(
-            f"User {user_id} status in chat {chat_id}: {chat_member.status}"
-        )
+        now = time.monotonic()
+        entry = _admin_status_cache.get((chat_id, user_id))
+        if entry and now - entry[0] < ADMIN_STATUS_CACHE_TTL:
+            status = entry[1]
+        else:
+            chat_member = await context.bot.get_chat_member(chat_id, user_id)
+            status = chat_member.status
+            _admin_status_cache[(chat_id, user_id)] = (now, status)
+
+            # Логируем информацию о статусе
+            logger.info(
+                "User %s status in chat %s: %s", user_id, chat_id, status
+            )
 
-        return chat_member.status in ["creator", "administrator"]
+        return status in ADMIN_STATUSES
     except Exception as e:
         logger.error(
-            f"Error checking admin status for user {user_id} in chat {chat_id}: {e}"
+            "Error checking admin status for user %s in chat %s: %s",
+            user_id,
+            chat_id,
+            e,
         )
         return False
 
 
-async def find_messages_by_hashtag(chat_id: int, hashtag: str) -> list:
-    try:
-        with session_scope() as session:
-            # Ищем первоначальные сообщения
-            messages = (
-                session.query(Message)
-                .filter(
-                    Message.chat_id == chat_id,
-                    Message.text.like(f"%{hashtag}%"),
-                )
-                .all()
-            )
+async def find_messages_by_hashtag(
+    chat_id: int, tag: str, page_size: int = SEARCH_PAGE_SIZE
+):
+    """Отдаёт найденные по тегу сообщения страницами по page_size штук."""
+    # Имя автора собираем в SQL, чтобы получать готовые строки без ORM-объектов
+    author = func.coalesce(User.username, cast(User.user_id, String))
+
+    # Один запрос по таблице хештегов находит и исходные сообщения, и их
+    # отредактированные версии: у строки версии заполнен version_id
+    query = (
+        select(
+            Hashtag.id,
+            func.coalesce(MessageVersion.text, Message.text),
+            author,
+        )
+        .select_from(Hashtag)
+        .join(Message, Hashtag.message_id == Message.id)
+        .join(User, Message.user_id == User.user_id)
+        .outerjoin(MessageVersion, Hashtag.version_id == MessageVersion.id)
+        .where(
+            Hashtag.tag == tag,
+            Message.chat_id == chat_id,
+            Message.is_deleted.is_(False),
+        )
+        .order_by(Hashtag.id)
+    )
 
-            # Ищем отредактированные версии сообщений
-            versions = (
-                session.query(MessageVersion)
-                .join(Message)
-                .filter(
-                    Message.chat_id == chat_id,
-                    MessageVersion.text.like(f"%{hashtag}%"),
-                )
-                .all()
+    # Страницы выбираем по последнему Hashtag.id, а не через OFFSET: каждая
+    # следующая начинается сразу с нужного места индекса (tag, id)
+    last_id = 0
+    while True:
+        async with session_scope() as session:
+            result = await session.execute(
+                query.where(Hashtag.id > last_id).limit(page_size)
             )
+            rows = result.all()
+
+        if rows:
+            yield [{"text": text, "author": name} for _, text, name in rows]
+
+        if len(rows) < page_size:
+            break
+        last_id = rows[-1][0]
+
+
+def pack_messages(blocks: list[str]) -> list[str]:
+    """Склеивает блоки текста в сообщения не длиннее лимита Telegram."""
+    limit = MessageLimit.MAX_TEXT_LENGTH
+    messages = []
+    current = ""
+    for block in blocks:
+        block = block[:limit]
+        if current and len(current) + 2 + len(block) > limit:
+            messages.append(current)
+            current = block
+        else:
+            current = f"{current}\n\n{block}" if current else block
+    if current:
+        messages.append(current)
+    return messages
 
-            results = []
-            for msg in messages:
-                results.append(
-                    {
-                        "text": msg.text,
-                        "author": msg.user.username or msg.user.user_id,
-                    }
-                )
 
-            for version in versions:
-                results.append(
-                    {
-                        "text": version.text,
-                        "author": version.original_message.user.username
-                        or version.original_message.user.user_id,
-                    }
-                )
+async def post_init(application: Application) -> None:
+    await init_db()
+    application.bot_data["message_writer"] = asyncio.create_task(
+        run_message_writer()
+    )
 
-            logger.info(
-                f"Found {len(results)} messages for hashtag {hashtag} in chat {chat_id}."
-            )
-            return results
 
-    except Exception as e:
-        logger.error(
-            f"Error searching messages by hashtag '{hashtag}' in chat {chat_id}: {e}"
-        )
-        return []
+async def post_shutdown(application: Application) -> None:
+    # Если init_db в post_init упал, фоновой записи ещё нет
+    writer = application.bot_data.pop("message_writer", None)
+    try:
+        if writer is not None:
+            # Дожидаемся записи сообщений, оставшихся в очереди
+            await message_queue.join()
+            writer.cancel()
+            with suppress(asyncio.CancelledError):
+                await writer
+    finally:
+        await dispose_engine()
 
 
 def main() -> None:
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Обработчик отредактированных сообщений
     application.add_handler(
@@ -344,8 +468,16 @@ def main() -> None:
         )
     )
 
-    # Запуск бота
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Запуск бота. Очередь логов подключаем только здесь, вместе с потоком,
+    # который её разбирает: при импорте bot записи не должны копиться в ней
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+    log_listener.start()
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,9 @@
-from contextlib import contextmanager
-from datetime import datetime
+import asyncio
+import functools
+import logging
+import os
+import re
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 from sqlalchemy import (
@@ -8,33 +12,102 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     String,
-    create_engine,
+    func,
+    inspect,
+    make_url,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger(__name__)
+
+# Новые сообщения пишутся в базу пачками: не больше MESSAGE_BATCH_SIZE
+# за раз и не дольше MESSAGE_BATCH_INTERVAL секунд ожидания
+MESSAGE_BATCH_SIZE = 1000
+MESSAGE_BATCH_INTERVAL = 0.2
+KNOWN_USERS_MAX_SIZE = 100_000
+# Telegram не пропускает сообщения длиннее 4096 символов
+MESSAGE_TEXT_MAX_LENGTH = 4096
+
+
+def read_setting(name, default_file):
+    """Читает настройку из NAME, файла из NAME_FILE или файла по умолчанию."""
+    value = os.environ.get(name)
+    if value:
+        return value
+    path = os.environ.get(f"{name}_FILE") or Path(__file__).with_name(
+        default_file
+    )
+    return Path(path).read_text().strip()
 
-path = Path(__file__).parent.joinpath("db_url.txt")
-with path.open() as f:
-    DATABASE_URL = f.read().strip()
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
 
 
-@contextmanager
-def session_scope():
-    """Контекстный менеджер для работы с сессией базы данных."""
-    session = Session()
-    try:
+@functools.cache
+def database_url():
+    """Читает адрес базы один раз и только при первом подключении."""
+    return read_setting("DATABASE_URL", "db_url.txt")
+
+
+@functools.cache
+def get_engine():
+    """Создаёт движок при первом обращении, а не при импорте модуля."""
+    url = make_url(database_url())
+    # Для PostgreSQL всегда берём асинхронный драйвер, даже если в адресе
+    # указан postgres:// или postgresql+psycopg2://
+    if url.get_backend_name() in ("postgres", "postgresql"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return create_async_engine(
+        url,
+        pool_size=20,
+        max_overflow=40,
+        # При исчерпанном пуле лучше быстро получить ошибку, чем копить
+        # зависшие обработчики
+        pool_timeout=5,
+        # Переподключаемся до того, как сервер или балансировщик закроет
+        # простаивающее соединение
+        pool_recycle=1800,
+        pool_pre_ping=True,  # Проверяем соединение перед выдачей из пула
+        # Многострочным INSERT ... VALUES уходит только вставка сообщений с
+        # RETURNING (лимит параметров asyncpg SQLAlchemy учитывает сам);
+        # хештеги и пользователи без RETURNING идут через executemany
+        insertmanyvalues_page_size=10_000,
+        # С запасом, чтобы скомпилированные выражения бота не вытеснялись
+        query_cache_size=1200,
+        connect_args={"server_settings": {"jit": "off"}},
+    )
+
+
+async def dispose_engine():
+    """Закрывает соединения пула, если движок уже был создан."""
+    if get_engine.cache_info().currsize:
+        await get_engine().dispose()
+
+
+@functools.cache
+def get_sessionmaker():
+    return async_sessionmaker(
+        get_engine(), class_=AsyncSession, expire_on_commit=False
+    )
+
+
+@asynccontextmanager
+async def session_scope():
+    """Сессия с одной транзакцией: коммит при успехе, откат при ошибке."""
+    async with get_sessionmaker().begin() as session:
         yield session
-        session.commit()  # Коммит изменений после успешного выполнения
-    except Exception as e:
-        session.rollback()  # Откат изменений в случае ошибки
-        raise e  # Повторно выбрасываем исключение
-    finally:
-        session.close()  # Закрываем сессию
 
 
 class User(Base):
@@ -46,7 +119,11 @@ class User(Base):
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
 
-    messages = relationship("Message", back_populates="user")
+    # Ленивая подгрузка связей запрещена во всех моделях: случайное
+    # обращение к ним падает сразу, а не превращается в N+1 запросов
+    messages = relationship(
+        "Message", back_populates="user", lazy="raise_on_sql"
+    )
 
 
 class Message(Base):
@@ -54,97 +131,411 @@ class Message(Base):
     id = Column(BigInteger, primary_key=True, autoincrement=False)
     chat_id = Column(BigInteger)
     user_id = Column(BigInteger, ForeignKey("users.user_id"))
-    text = Column(String)  # Первоначальный текст сообщения
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # Первоначальный текст сообщения
+    text = Column(String(MESSAGE_TEXT_MAX_LENGTH))
+    created_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
     is_deleted = Column(Boolean, default=False)
     is_edited = Column(Boolean, default=False)
 
-    user = relationship("User", back_populates="messages")
-    versions = relationship("MessageVersion", back_populates="original_message")
+    user = relationship("User", back_populates="messages", lazy="raise_on_sql")
+    versions = relationship(
+        "MessageVersion",
+        back_populates="original_message",
+        lazy="raise_on_sql",
+    )
+    hashtags = relationship(
+        "Hashtag", back_populates="message", lazy="raise_on_sql"
+    )
 
 
 class MessageVersion(Base):
     __tablename__ = "message_versions"
     id = Column(BigInteger, primary_key=True)
     message_id = Column(BigInteger, ForeignKey("messages.id"))
-    text = Column(String)  # Текст новой версии
-    edited_at = Column(DateTime, default=datetime.utcnow)
+    text = Column(String(MESSAGE_TEXT_MAX_LENGTH))  # Текст новой версии
+    edited_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+    original_message = relationship(
+        "Message", back_populates="versions", lazy="raise_on_sql"
+    )
+    hashtags = relationship(
+        "Hashtag", back_populates="version", lazy="raise_on_sql"
+    )
+
+
+class Hashtag(Base):
+    __tablename__ = "hashtags"
+    id = Column(BigInteger, primary_key=True)
+    message_id = Column(BigInteger, ForeignKey("messages.id"))
+    # Заполняется, если хештег найден в отредактированной версии сообщения
+    version_id = Column(
+        BigInteger, ForeignKey("message_versions.id"), nullable=True
+    )
+    tag = Column(String)
+
+    message = relationship(
+        "Message", back_populates="hashtags", lazy="raise_on_sql"
+    )
+    version = relationship(
+        "MessageVersion", back_populates="hashtags", lazy="raise_on_sql"
+    )
 
-    original_message = relationship("Message", back_populates="versions")
+    # Поиск идёт по тегу страницами в порядке id
+    __table_args__ = (Index("ix_hashtags_tag_id", "tag", "id"),)
 
 
-Base.metadata.create_all(engine)
+def create_indexes(connection):
+    """Создаёт объявленные в моделях индексы и для уже существующих таблиц."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
 
 
-def get_or_create_user(session, user):
-    user_id = user.id
-    username = user.username
-    full_name = user.full_name
-    first_name = user.first_name
-    last_name = user.last_name
+def create_tables(connection):
+    """Создаёт недостающие таблицы и возвращает имена созданных."""
+    inspector = inspect(connection)
+    existing = set(inspector.get_table_names())
+    missing = [
+        table
+        for table in Base.metadata.sorted_tables
+        if table.name not in existing
+    ]
+    if missing:
+        Base.metadata.create_all(connection, tables=missing, checkfirst=False)
+    set_timestamp_defaults(connection, inspector, existing)
+    return {table.name for table in missing}
 
-    existing_user = session.query(User).filter_by(user_id=user_id).first()
-    if not existing_user:
-        # Создаём нового пользователя
-        new_user = User(
-            user_id=user_id,
-            username=username,
-            full_name=full_name,
-            first_name=first_name,
-            last_name=last_name,
+
+def set_timestamp_defaults(connection, inspector, existing):
+    """Ставит DEFAULT now() в таблицах, созданных старой схемой без него."""
+    for table, column in (
+        ("messages", "created_at"),
+        ("message_versions", "edited_at"),
+    ):
+        if table not in existing:
+            continue
+        columns = {info["name"]: info for info in inspector.get_columns(table)}
+        # ALTER TABLE берёт эксклюзивную блокировку, поэтому только по делу
+        if columns[column]["default"] is None:
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} "
+                    f"ALTER COLUMN {column} SET DEFAULT now()"
+                )
+            )
+
+
+def backfill_hashtags(connection):
+    """Заполняет таблицу хештегов для сообщений, сохранённых до её появления.
+
+    Вызывается только в транзакции, которая саму таблицу и создала, поэтому
+    проверять уже записанные хештеги не нужно.
+    """
+    connection.execute(
+        text(
+            "INSERT INTO hashtags (message_id, tag) "
+            "SELECT DISTINCT m.id, lower(t[1]) FROM messages m "
+            r"CROSS JOIN LATERAL regexp_matches(m.text, '#(\w+)', 'g') t "
+            "WHERE m.text LIKE '%#%'"
         )
-        session.add(new_user)
-    else:
-        # Обновляем данные пользователя, если они изменились
-        if username and existing_user.username != username:
-            existing_user.username = username
-        # if first_name and user.first_name != first_name:
-        #     user.first_name = first_name
-        # if last_name and user.last_name != last_name:
-        #     user.last_name = last_name
-    session.commit()
-    return existing_user or new_user
-
-
-def save_message(session, chat_id, user, text, message_id=None):
-    try:
-        get_or_create_user(session, user)
-        message = Message(
-            id=message_id, chat_id=chat_id, user_id=user.id, text=text
+    )
+    connection.execute(
+        text(
+            "INSERT INTO hashtags (message_id, version_id, tag) "
+            "SELECT DISTINCT v.message_id, v.id, lower(t[1]) "
+            "FROM message_versions v "
+            r"CROSS JOIN LATERAL regexp_matches(v.text, '#(\w+)', 'g') t "
+            "WHERE v.text LIKE '%#%'"
+        )
+    )
+
+
+async def init_db():
+    """Создаёт таблицы и индексы, если их ещё нет."""
+    async with get_engine().begin() as connection:
+        created = await connection.run_sync(create_tables)
+        # Обновление со схемы без таблицы хештегов: заполняем её один раз
+        if "hashtags" in created:
+            await connection.run_sync(backfill_hashtags)
+        await connection.run_sync(create_indexes)
+
+
+HASHTAG_RE = re.compile(r"#(\w+)")
+
+
+def normalize_hashtag(hashtag):
+    """Выделяет тег так же, как при сохранении; None, если тега нет."""
+    match = HASHTAG_RE.match(hashtag)
+    return match.group(1).lower() if match else None
+
+
+def extract_hashtags(text):
+    """Возвращает множество нормализованных хештегов из текста."""
+    if not text:
+        return set()
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+def build_upsert_users():
+    stmt = insert(User.__table__)
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"username": stmt.excluded.username},
+        # Обновляем username, только если пользователь его не скрыл и он
+        # изменился: иначе строка не переписывается и ничего не блокирует
+        where=stmt.excluded.username.is_not(None)
+        & User.username.is_distinct_from(stmt.excluded.username),
+    )
+
+
+# Выражения пути записи собираются один раз при импорте: каждая пачка
+# берёт их скомпилированную форму из кэша движка
+UPSERT_USERS = build_upsert_users()
+INSERT_MESSAGES = (
+    insert(Message.__table__)
+    .on_conflict_do_nothing(index_elements=["id"])
+    .returning(Message.chat_id, Message.id)
+)
+INSERT_HASHTAGS = insert(Hashtag.__table__)
+
+
+async def upsert_users(connection, users):
+    """Создаёт пользователей или обновляет их username через executemany."""
+    await connection.execute(
+        UPSERT_USERS,
+        [
+            {
+                "user_id": user.id,
+                "username": user.username,
+                "full_name": user.full_name,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+            }
+            for user in users
+        ],
+    )
+
+
+# Пользователи, уже записанные в базу: user_id -> username
+_known_users = {}
+
+
+def is_known_user(user):
+    """Проверяет, что пользователь уже в базе и его username не изменился."""
+    if user.id not in _known_users:
+        return False
+    # Пустой username не перезаписывает сохранённый, см. upsert_users
+    return user.username is None or user.username == _known_users[user.id]
+
+
+def remember_users(users):
+    """Запоминает пользователей после успешной записи в базу."""
+    if len(_known_users) >= KNOWN_USERS_MAX_SIZE:
+        _known_users.clear()
+    for user in users:
+        _known_users[user.id] = user.username or _known_users.get(user.id)
+
+
+async def save_messages(connection, batch):
+    """Сохраняет пачку сообщений, их авторов и хештеги.
+
+    Пишет через Core-соединение в обход ORM: asyncpg выполняет эти
+    INSERT как подготовленные выражения из кэша соединения.
+    """
+    users = {
+        user.id: user for _, user, _, _, _ in batch if not is_known_user(user)
+    }
+    if users:
+        await upsert_users(connection, users.values())
+
+    # id сообщения в Telegram уникален только в пределах чата, поэтому
+    # повторы внутри пачки отбрасываем по паре (chat_id, id)
+    rows = {}
+    for chat_id, user, message_text, message_id, date in batch:
+        rows.setdefault(
+            (chat_id, message_id),
+            {
+                "id": message_id,
+                "chat_id": chat_id,
+                "user_id": user.id,
+                "text": message_text,
+                # Время отправки из Telegram, а не время записи пачки
+                "created_at": date,
+            },
         )
-        session.add(message)
+    result = await connection.execute(INSERT_MESSAGES, list(rows.values()))
+    saved = set(result.tuples())
+
+    # Строка с уже занятым id не вставляется: первичный ключ у сообщений
+    # только id, так что такое сообщение не будет сохранено
+    skipped = [key for key in rows if key not in saved]
+    if skipped:
+        logger.warning(
+            "Skipped %s messages whose id is already stored, "
+            "(chat_id, id): %s",
+            len(skipped),
+            skipped,
+        )
+
+    hashtag_rows = [
+        {"message_id": message_id, "tag": tag}
+        for (chat_id, message_id), row in rows.items()
+        if (chat_id, message_id) in saved
+        for tag in extract_hashtags(row["text"])
+    ]
+    if hashtag_rows:
+        await connection.execute(INSERT_HASHTAGS, hashtag_rows)
+    return len(saved)
+
+
+# Новые сообщения и правки идут через одну очередь: правка записывается
+# только после того, как её сообщение уже попало в базу
+message_queue = asyncio.Queue()
+NEW_MESSAGE = "new"
+EDITED_MESSAGE = "edit"
+
+
+def queue_message(chat_id, user, text, message_id, date):
+    """Ставит новое сообщение в очередь на пакетную запись."""
+    message_queue.put_nowait(
+        (NEW_MESSAGE, (chat_id, user, text, message_id, date))
+    )
+
+
+def queue_edit(chat_id, user_id, message_id, new_text, edited_at):
+    """Ставит правку сообщения в очередь вслед за новыми сообщениями."""
+    message_queue.put_nowait(
+        (EDITED_MESSAGE, (chat_id, user_id, message_id, new_text, edited_at))
+    )
+
+
+async def write_new_messages(messages):
+    try:
+        async with get_engine().begin() as connection:
+            saved = await save_messages(connection, messages)
+        remember_users(user for _, user, _, _, _ in messages)
+        logger.info("Saved %s of %s queued messages", saved, len(messages))
     except Exception as e:
-        session.rollback()
-        raise e
+        logger.error("Error saving batch of %s messages: %s", len(messages), e)
 
 
-def update_message(session, chat_id, user_id, message_id, new_text, edited_at):
+async def write_edit(chat_id, user_id, message_id, new_text, edited_at):
     try:
-        message = (
-            session.query(Message)
-            .filter_by(chat_id=chat_id, user_id=user_id, id=message_id)
-            .first()
+        async with session_scope() as session:
+            updated = await update_message(
+                session, chat_id, user_id, message_id, new_text, edited_at
+            )
+        if updated:
+            logger.info(
+                "Saved edit of message %s in chat %s", message_id, chat_id
+            )
+        else:
+            logger.warning(
+                "Edited message %s in chat %s by user %s not found, "
+                "edit skipped",
+                message_id,
+                chat_id,
+                user_id,
+            )
+    except Exception as e:
+        logger.error("Error saving edit of message %s: %s", message_id, e)
+
+
+async def write_message_batch(batch):
+    # Правки пишем после новых сообщений: правка не может прийти раньше
+    # своего сообщения, а оно могло оказаться в этой же пачке
+    messages = [item for kind, item in batch if kind == NEW_MESSAGE]
+    if messages:
+        await write_new_messages(messages)
+    for kind, item in batch:
+        if kind == EDITED_MESSAGE:
+            await write_edit(*item)
+
+
+async def run_message_writer():
+    """Фоновая задача, записывающая сообщения из очереди пачками."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await message_queue.get()]
+        deadline = loop.time() + MESSAGE_BATCH_INTERVAL
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(
+                    await asyncio.wait_for(message_queue.get(), timeout)
+                )
+            except TimeoutError:
+                break
+
+        await write_message_batch(batch)
+        for _ in batch:
+            message_queue.task_done()
+
+
+async def update_message(
+    session, chat_id, user_id, message_id, new_text, edited_at
+):
+    try:
+        # Помечаем сообщение отредактированным без предварительного SELECT
+        result = await session.execute(
+            update(Message)
+            .where(
+                Message.id == message_id,
+                Message.chat_id == chat_id,
+                Message.user_id == user_id,
+            )
+            .values(is_edited=True)
+            .returning(Message.id)
         )
-        if message:
-            message.is_edited = True
-            version = MessageVersion(
-                message_id=message.id, text=new_text, edited_at=edited_at
+        if result.scalar_one_or_none() is None:
+            return False
+
+        version_id = await session.scalar(
+            insert(MessageVersion.__table__)
+            .values(
+                message_id=message_id,
+                text=new_text,
+                # Без даты правки от Telegram время ставит сама база
+                edited_at=edited_at or func.now(),
             )
-            session.add(version)
+            .returning(MessageVersion.id)
+        )
+        hashtag_rows = [
+            {"message_id": message_id, "version_id": version_id, "tag": tag}
+            for tag in extract_hashtags(new_text)
+        ]
+        if hashtag_rows:
+            await session.execute(INSERT_HASHTAGS, hashtag_rows)
+        return True
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         raise e
 
 
-def mark_message_as_deleted(session, chat_id, user_id):
+async def mark_messages_as_deleted(session, chat_id, user_id, message_ids):
+    """Помечает удалёнными сразу несколько сообщений одним UPDATE."""
     try:
-        message = (
-            session.query(Message)
-            .filter_by(chat_id=chat_id, user_id=user_id)
-            .first()
+        # id сообщений повторяются в разных чатах, поэтому фильтруем и по
+        # чату с автором
+        await session.execute(
+            update(Message)
+            .where(
+                Message.chat_id == chat_id,
+                Message.user_id == user_id,
+                Message.id.in_(message_ids),
+            )
+            .values(is_deleted=True)
         )
-        if message:
-            message.is_deleted = True
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         raise e
+
+
+async def mark_message_as_deleted(session, chat_id, user_id, message_id):
+    await mark_messages_as_deleted(session, chat_id, user_id, [message_id])